@@ -0,0 +1,108 @@
+# src/concurrency.py
+import asyncio
+import time
+import uuid
+import logging
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimiter:
+    """
+    Caps how many requests a single client may have in progress at the same time.
+
+    With a Redis client, each client's active requests are tracked in a sorted set scored by
+    start time, so the cap holds across all Uvicorn workers. Without Redis, counts are kept
+    in-process.
+    """
+
+    def __init__(self, max_concurrent: int, redis_client=None, stale_after_seconds: int = 300):
+        self.max_concurrent = max_concurrent
+        self.redis = redis_client
+        # Entries older than this are assumed to belong to crashed workers and are dropped
+        self.stale_after_seconds = stale_after_seconds
+        self._local_counts = {}
+
+    async def acquire(self, client_id: str):
+        """
+        Registers a new active request. Returns a token to pass to release(), or None if the client is at its limit.
+        """
+        token = uuid.uuid4().hex
+
+        if self.redis is None:
+            if self._local_counts.get(client_id, 0) >= self.max_concurrent:
+                return None
+            self._local_counts[client_id] = self._local_counts.get(client_id, 0) + 1
+            return token
+
+        key = f"concurrency:{client_id}"
+        now = time.time()
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(key, 0, now - self.stale_after_seconds)
+                pipe.zadd(key, {token: now})
+                pipe.zcard(key)
+                pipe.expire(key, self.stale_after_seconds)
+                _, _, active_count, _ = await pipe.execute()
+
+            if active_count > self.max_concurrent:
+                await self.redis.zrem(key, token)
+                return None
+        except redis.RedisError as e:
+            # Fail open: a Redis outage should not take the API down with it
+            logger.warning(f"Concurrency limiter unavailable, allowing request: {e}")
+        return token
+
+    async def release(self, client_id: str, token: str):
+        if self.redis is None:
+            remaining = self._local_counts.get(client_id, 0) - 1
+            if remaining > 0:
+                self._local_counts[client_id] = remaining
+            else:
+                self._local_counts.pop(client_id, None)
+            return
+
+        try:
+            await self.redis.zrem(f"concurrency:{client_id}", token)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to release concurrency slot: {e}")
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit for calls to an upstream API.
+
+    The limit grows additively after each call that succeeds within the target latency and is
+    cut multiplicatively when the upstream reports overload (e.g. HTTP 429/5xx), so the service
+    backs off before piling more requests onto an exhausted quota.
+    """
+
+    def __init__(self, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 16,
+                 increase_by: float = 1.0, decrease_factor: float = 0.5,
+                 target_latency_seconds: float = 15.0):
+        self.limit = float(min(initial_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase_by = increase_by
+        self.decrease_factor = decrease_factor
+        self.target_latency_seconds = target_latency_seconds
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def release(self, latency_seconds: float, overloaded: bool = False):
+        async with self._condition:
+            self._in_flight -= 1
+
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                logger.warning(f"Upstream overloaded, reducing concurrency limit to {int(self.limit)}")
+            elif latency_seconds <= self.target_latency_seconds:
+                self.limit = min(self.max_limit, self.limit + self.increase_by)
+
+            self._condition.notify_all()
@@ -3,4 +3,17 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
\ No newline at end of file
+GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+# Optional shared cache for multi-worker deployments, e.g. "redis://localhost:6379/0"
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Maximum number of /generate requests a single client may have in progress at once
+MAX_CONCURRENT_REQUESTS_PER_CLIENT = int(os.getenv("MAX_CONCURRENT_REQUESTS_PER_CLIENT", "3"))
+
+# Upper bounds on concurrent Gemini calls and .pptx builds per worker, to apply backpressure under load
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS", "8"))
+MAX_CONCURRENT_PPTX_BUILDS = int(os.getenv("MAX_CONCURRENT_PPTX_BUILDS", "4"))
+
+# Directory for the persistent on-disk LLM response cache
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "llm_cache")
@@ -1,16 +1,18 @@
 # src/main.py
-import os
-import uuid
 import asyncio
+from contextvars import ContextVar
+from urllib.parse import quote
 import logging  # --- LOGGING: Import the logging module ---
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 
 # Import slowapi components
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
+from .concurrency import ConcurrencyLimiter
+from .config import MAX_CONCURRENT_PPTX_BUILDS, MAX_CONCURRENT_REQUESTS_PER_CLIENT, REDIS_URL
 from .models import PresentationRequest
 from .services import LLMService, SlideBuilderService
 
@@ -22,8 +24,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize the Limiter
-limiter = Limiter(key_func=get_remote_address)
+# Initialize the Limiter, sharing counters across workers through Redis when it is configured
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=REDIS_URL or "memory://",
+    in_memory_fallback_enabled=True
+)
 
 app = FastAPI(
     title="Slide Generator API",
@@ -37,15 +43,61 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 # Instantiate our services
 llm_service = LLMService()
 slide_builder_service = SlideBuilderService()
+concurrency_limiter = ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS_PER_CLIENT, redis_client=llm_service.redis)
+
+# Bounds how many .pptx builds occupy the default thread pool at once
+pptx_build_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PPTX_BUILDS)
+
+# Set per request before the rate limit is checked; slowapi's exempt_when callback takes no arguments
+_likely_cache_hit: ContextVar[bool] = ContextVar("likely_cache_hit", default=False)
+
+PPTX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+
+
+def _content_disposition(filename: str) -> str:
+    # Same encoding rules as FileResponse: fall back to RFC 5987 for non-ASCII names
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+@app.middleware("http")
+async def limit_concurrent_generations(request: Request, call_next):
+    """
+    Rejects /generate requests from clients that already have too many generations in progress.
+    """
+    if request.url.path != "/generate":
+        return await call_next(request)
+
+    client_id = get_remote_address(request)
+    token = await concurrency_limiter.acquire(client_id)
+    if token is None:
+        logger.warning(f"Too many concurrent requests from {client_id}")
+        return JSONResponse(
+            {"error": f"Too many concurrent requests: limit of {MAX_CONCURRENT_REQUESTS_PER_CLIENT}"},
+            status_code=429
+        )
 
-# Ensure the output directory exists
-OUTPUT_DIR = "generated_presentations"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+    try:
+        return await call_next(request)
+    finally:
+        await concurrency_limiter.release(client_id, token)
 
 
-@app.post("/generate", response_class=FileResponse)
-@limiter.limit("5/minute")
-async def generate_presentation(request: Request, presentation_request: PresentationRequest):
+async def peek_cache(presentation_request: PresentationRequest) -> PresentationRequest:
+    """
+    Records whether the request will likely be served from cache, so it doesn't consume rate limit quota.
+    """
+    _likely_cache_hit.set(
+        llm_service.is_cached(presentation_request.topic, presentation_request.num_slides)
+    )
+    return presentation_request
+
+
+@app.post("/generate", response_class=Response)
+@limiter.limit("5/minute", exempt_when=_likely_cache_hit.get)
+async def generate_presentation(request: Request, presentation_request: PresentationRequest = Depends(peek_cache)):
     """
     Accepts a topic and number of slides, generates a .pptx file, and returns it.
     """
@@ -67,25 +119,23 @@ async def generate_presentation(request: Request, presentation_request: Presenta
     # Step 2: Build the .pptx file using the Slide Builder Service
     try:
         logger.info("Starting presentation generation.")
-        unique_filename = f"{uuid.uuid4()}.pptx"
-        output_path = os.path.join(OUTPUT_DIR, unique_filename)
-
-        await asyncio.to_thread(
-            slide_builder_service.create_presentation,
-            content_data,
-            output_path,
-            presentation_request.aspect_ratio.value
-        )
-        logger.info(f"Successfully created presentation: {output_path}")
+        async with pptx_build_semaphore:
+            pptx_bytes = await asyncio.to_thread(
+                slide_builder_service.create_presentation,
+                content_data,
+                presentation_request.aspect_ratio.value
+            )
+        logger.info(f"Successfully created presentation ({len(pptx_bytes)} bytes).")
     except Exception as e:
         logger.error(f"Failed to create presentation file: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to create presentation file: {e}")
 
-    # Step 3: Return the generated file
-    return FileResponse(
-        path=output_path,
-        media_type='application/vnd.openxmlformats-officedocument.presentationml.presentation',
-        filename=f"{presentation_request.topic.replace(' ', '_')}_presentation.pptx"
+    # Step 3: Return the generated file straight from memory
+    filename = f"{presentation_request.topic.replace(' ', '_')}_presentation.pptx"
+    return Response(
+        content=pptx_bytes,
+        media_type=PPTX_MEDIA_TYPE,
+        headers={"Content-Disposition": _content_disposition(filename)}
     )
 
 
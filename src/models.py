@@ -1,4 +1,5 @@
 # src/models.py
+from typing import List, Optional
 from pydantic import BaseModel, Field
 from enum import Enum # --- NEW: Import Enum ---
 
@@ -24,4 +25,30 @@ class PresentationRequest(BaseModel):
     aspect_ratio: AspectRatio = Field(
         default=AspectRatio.widescreen,
         description="The aspect ratio for the presentation slides."
-    )
\ No newline at end of file
+    )
+
+
+# --- Response schema passed to Gemini to force structured JSON output ---
+# Fields are left without defaults because Gemini's schema format has no "default" keyword.
+class SlideLayout(str, Enum):
+    title_slide = "title_slide"
+    bullet_points = "bullet_points"
+    two_column = "two_column"
+
+class ColumnContent(BaseModel):
+    heading: Optional[str]
+    points: List[str]
+
+class SlideContent(BaseModel):
+    title: str
+    subtitle: Optional[str]
+    points: Optional[List[str]]
+    left_column: Optional[ColumnContent]
+    right_column: Optional[ColumnContent]
+
+class Slide(BaseModel):
+    layout: SlideLayout
+    content: SlideContent
+
+class SlidesResponse(BaseModel):
+    slides: List[Slide]
@@ -1,12 +1,21 @@
 # src/services.py
 import google.generativeai as genai
-import json
-import re
+import asyncio
+import io
+import time
+import hashlib
+import orjson
 import logging  # --- LOGGING: Import the logging module ---
+import numpy as np
+import redis.asyncio as redis
+from diskcache import Cache
+from google.api_core import exceptions as google_exceptions
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from pptx.dml.color import RGBColor
-from .config import GEMINI_API_KEY
+from .concurrency import AIMDLimiter
+from .config import GEMINI_API_KEY, LLM_CACHE_DIR, MAX_CONCURRENT_LLM_CALLS, REDIS_URL
+from .models import SlidesResponse
 
 # --- LOGGING: Get a logger instance for this module ---
 logger = logging.getLogger(__name__)
@@ -14,6 +23,20 @@ logger = logging.getLogger(__name__)
 # Configure the Gemini API client
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Bump this whenever the prompt in LLMService changes so stale cached responses are ignored
+PROMPT_TEMPLATE_VERSION = "v2"
+# Cached responses expire after this long, in both the local disk cache and Redis
+CACHE_TTL_SECONDS = 7 * 86400
+LLM_CACHE_SIZE_LIMIT_BYTES = 200 << 20
+
+# Gemini errors that mean "slow down" rather than "this request is bad"
+GEMINI_OVERLOAD_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+)
+
 
 class PresentationStyles:
     TITLE_FONT_NAME = 'Calibri Light'
@@ -24,79 +47,191 @@ class PresentationStyles:
     BODY_COLOR = RGBColor(0x33, 0x33, 0x33)  # Dark Gray
 
 
+class SemanticCache:
+    """
+    In-process cache that matches topics by embedding similarity, so that
+    paraphrased topics can reuse an earlier LLM response.
+    """
+
+    def __init__(self, threshold=0.92, max_size=100):
+        self.threshold = threshold
+        self.max_size = max_size
+        self._matrix = None  # One normalized embedding per row
+        self._num_slides = np.empty(0, dtype=np.int32)
+        self._entries = []
+
+    def lookup(self, vector, num_slides: int):
+        if self._matrix is None:
+            return None
+
+        scores = np.dot(self._matrix, vector)
+        scores[self._num_slides != num_slides] = -1.0
+        best = int(np.argmax(scores))
+
+        if scores[best] > self.threshold:
+            return self._entries[best]
+        return None
+
+    def add(self, vector, num_slides: int, parsed_json: dict):
+        if self._matrix is None:
+            self._matrix = vector[np.newaxis, :]
+        else:
+            self._matrix = np.vstack([self._matrix, vector])
+        self._num_slides = np.append(self._num_slides, num_slides)
+        self._entries.append(parsed_json)
+
+        if len(self._entries) > self.max_size:
+            self._matrix = self._matrix[1:]
+            self._num_slides = self._num_slides[1:]
+            self._entries.pop(0)
+
+
 class LLMService:
     """
     Service for interacting with the Google Gemini LLM.
     """
 
-    def __init__(self, model_name="gemini-2.0-flash"):
-        self.model = genai.GenerativeModel(model_name)
-        self.cache = {}
-        self.max_cache_size = 100
+    def __init__(self, model_name="gemini-2.0-flash", embedding_model="models/text-embedding-004"):
+        # Force JSON output matching SlidesResponse so the response never needs cleaning up
+        self.model = genai.GenerativeModel(
+            model_name,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": SlidesResponse,
+            },
+        )
+        self.embedding_model = embedding_model
+        # SQLite-backed so cached responses survive restarts; handles LRU eviction by size itself
+        self.cache = Cache(
+            LLM_CACHE_DIR,
+            size_limit=LLM_CACHE_SIZE_LIMIT_BYTES,
+            eviction_policy="least-recently-used",
+        )
+        self.semantic_cache = SemanticCache()
+        self.redis = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+        # In-flight generations keyed by cache key, so concurrent requests for the same topic share one call
+        self._inflight = {}
+        # Adapts how many Gemini calls may run at once based on latency and overload errors,
+        # never exceeding MAX_CONCURRENT_LLM_CALLS
+        self.llm_limiter = AIMDLimiter(max_limit=MAX_CONCURRENT_LLM_CALLS)
+
+    def _cache_key(self, topic: str, num_slides: int) -> str:
+        raw_key = f"{self.model.model_name}|{topic.lower()}|{num_slides}|{PROMPT_TEMPLATE_VERSION}"
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def is_cached(self, topic: str, num_slides: int) -> bool:
+        """
+        Cheap check for whether a request would be served from the local disk cache.
+        """
+        return self._cache_key(topic, num_slides) in self.cache
+
+    async def _get_from_redis(self, cache_key: str):
+        if self.redis is None:
+            return None
+        try:
+            value = await self.redis.get(cache_key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache lookup failed: {e}")
+            return None
+        return orjson.loads(value) if value is not None else None
+
+    async def _set_in_redis(self, cache_key: str, parsed_json: dict):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(cache_key, orjson.dumps(parsed_json), ex=CACHE_TTL_SECONDS)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache write failed: {e}")
+
+    async def _embed_topic(self, topic: str):
+        """
+        Returns the normalized embedding of a topic, or None if embedding fails.
+        """
+        try:
+            result = await genai.embed_content_async(
+                model=self.embedding_model, content=topic, task_type="semantic_similarity"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to embed topic '{topic}', skipping semantic cache: {e}")
+            return None
+
+        vector = np.asarray(result["embedding"], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
 
     async def generate_slides_content(self, topic: str, num_slides: int) -> dict:
         """
         Generates structured presentation content using the LLM, with caching.
         """
-        cache_key = (topic.lower(), num_slides)
+        cache_key = self._cache_key(topic, num_slides)
 
-        if cache_key in self.cache:
+        cached = self.cache.get(cache_key)
+        if cached is not None:
             logger.info(f"CACHE HIT for topic: '{topic}'")
-            return self.cache[cache_key]
+            return cached
+
+        task = self._inflight.get(cache_key)
+        if task is not None:
+            logger.info(f"Joining in-flight generation for topic: '{topic}'")
+        else:
+            task = asyncio.ensure_future(self._generate_uncached(cache_key, topic, num_slides))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+
+        # Shield the shared task so one cancelled request doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def _generate_uncached(self, cache_key: str, topic: str, num_slides: int) -> dict:
+        """
+        Resolves a topic that missed the local cache via Redis, the semantic cache or the LLM.
+        """
+        cached = await self._get_from_redis(cache_key)
+        if cached is not None:
+            logger.info(f"REDIS CACHE HIT for topic: '{topic}'")
+            self._store_in_cache(cache_key, cached)
+            return cached
+
+        topic_vector = await self._embed_topic(topic)
+        if topic_vector is not None:
+            cached = self.semantic_cache.lookup(topic_vector, num_slides)
+            if cached is not None:
+                logger.info(f"SEMANTIC CACHE HIT for topic: '{topic}'")
+                self._store_in_cache(cache_key, cached)
+                await self._set_in_redis(cache_key, cached)
+                return cached
 
         logger.info(f"CACHE MISS for topic: '{topic}'. Calling Gemini API.")
 
-        # --- FIX: Added a stronger instruction to ensure valid JSON syntax ---
+        # The JSON structure is enforced by the response schema, so the prompt only covers content.
+        # Bump PROMPT_TEMPLATE_VERSION when changing it.
         prompt = f"""
         Generate a presentation about "{topic}".
         The presentation should have approximately {num_slides} slides.
 
-        Please provide the output in a single, valid JSON object. Do not include any text, introductory phrases, or markdown formatting like ```json before or after the JSON object.
-        The entire response should be only the JSON content.
-        VERY IMPORTANT: Ensure the JSON is perfectly formatted. Pay close attention to syntax, especially commas between objects in lists.
-
         IMPORTANT CONTENT RULES:
         - Each bullet point or definition should be descriptive and detailed, ideally between 15 and 20 words long.
         - You can use markdown for emphasis. Use **double asterisks** for bold and __double underscores__ for underline.
         - For bullet points, provide them as a list of strings without any leading characters like '*'.
 
-        The JSON object must have a single key "slides", which is a list of slide objects.
-        Each slide object must have two keys: "layout" and "content".
-
-        The "layout" key must be one of the following three strings:
-        1. "title_slide"
-        2. "bullet_points"
-        3. "two_column"
-
-        The "content" key must be an object with the following structure based on layout:
-        - For "title_slide": {{"title": "...", "subtitle": "..."}}
-        - For "bullet_points": {{"title": "...", "points": ["...", "..."]}}
-        - For "two_column": {{"title": "...", "left_column": {{"heading": "...", "points": ["...", "..."]}}, "right_column": {{"heading": "...", "points": ["...", "..."]}} }}
+        Fill in the "content" fields based on the layout:
+        - For "title_slide": "title" and "subtitle".
+        - For "bullet_points": "title" and "points".
+        - For "two_column": "title", "left_column" and "right_column", each with a "heading" and "points".
 
         Also, please include a slide with source citations at the end, using the "bullet_points" layout.
-
-        Now, generate the complete JSON for the presentation on "{topic}".
         """
 
         try:
-            response = await self.model.generate_content_async(prompt)
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-
-            parsed_json = json.loads(response_text)
+            response = await self._call_gemini(prompt)
+            parsed_json = orjson.loads(response.text)
 
-            self.cache[cache_key] = parsed_json
-
-            if len(self.cache) > self.max_cache_size:
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
-                logger.info("Cache max size reached. Removed oldest item.")
+            self._store_in_cache(cache_key, parsed_json)
+            await self._set_in_redis(cache_key, parsed_json)
+            if topic_vector is not None:
+                self.semantic_cache.add(topic_vector, num_slides, parsed_json)
 
             return parsed_json
-        except (json.JSONDecodeError, Exception) as e:
+        except (orjson.JSONDecodeError, Exception) as e:
             # --- LOGGING: Replaced print with logger.error and added more detail ---
             logger.error(f"Error decoding LLM response: {e}", exc_info=True)
             raw_response = "Response object not available"
@@ -106,6 +241,21 @@ class LLMService:
             logger.debug(f"Raw LLM Response that failed parsing:\n{raw_response}")
             return {"error": "Failed to generate or parse content from LLM.", "details": str(e)}
 
+    async def _call_gemini(self, prompt: str):
+        await self.llm_limiter.acquire()
+        start_time = time.monotonic()
+        overloaded = False
+        try:
+            return await self.model.generate_content_async(prompt)
+        except GEMINI_OVERLOAD_ERRORS:
+            overloaded = True
+            raise
+        finally:
+            await self.llm_limiter.release(time.monotonic() - start_time, overloaded)
+
+    def _store_in_cache(self, cache_key, parsed_json: dict):
+        self.cache.set(cache_key, parsed_json, expire=CACHE_TTL_SECONDS)
+
 
 class SlideBuilderService:
     # ... (The rest of this class remains exactly the same) ...
@@ -113,139 +263,213 @@ class SlideBuilderService:
     Service for building a .pptx presentation file.
     """
 
-    def _process_markdown_to_runs(self, paragraph, text):
-        paragraph.clear()
+    TEMPLATE_PATHS = {
+        "16:9": 'template_16_9.pptx',
+        "4:3": 'template_4_3.pptx',
+    }
+
+    # Index of the slide master layout used for each of our layout names
+    LAYOUT_INDICES = {
+        "title_slide": 0,
+        "bullet_points": 1,
+        "two_column": 3,
+    }
+
+    def __init__(self):
+        # Templates never change, so read them once and parse from memory on each request
+        self._template_bytes = {}
+        for aspect_ratio, template_path in self.TEMPLATE_PATHS.items():
+            try:
+                with open(template_path, "rb") as template_file:
+                    self._template_bytes[aspect_ratio] = template_file.read()
+            except FileNotFoundError:
+                self._template_bytes[aspect_ratio] = None
+
+    def _style_run(self, run, is_title=False):
+        if is_title:
+            if run.font.bold is not True: run.font.name = PresentationStyles.TITLE_FONT_NAME
+            run.font.size = PresentationStyles.TITLE_FONT_SIZE
+            run.font.color.rgb = PresentationStyles.TITLE_COLOR
+        else:
+            if run.font.bold is not True: run.font.name = PresentationStyles.BODY_FONT_NAME
+            run.font.size = PresentationStyles.BODY_FONT_SIZE
+            run.font.color.rgb = PresentationStyles.BODY_COLOR
+
+    def _split_markdown(self, text):
+        """
+        Splits markdown text into a list of (text, delimiter) runs, where delimiter is '**', '__' or None.
 
-        pattern = r'(\*\*|__)(.*?)\1'
-        parts = re.split(pattern, text)
+        A span opens at '**' or '__' and closes at the next identical delimiter on the same line.
+        Scanning with str.find avoids the backtracking a backreference regex needs.
+        """
+        runs = []
+        plain_start = 0
+        search_from = 0
+        # Next known position of each delimiter at or after search_from; -1 once none remain
+        next_star = text.find('**')
+        next_underscore = text.find('__')
+
+        while next_star != -1 or next_underscore != -1:
+            if next_underscore == -1 or (next_star != -1 and next_star < next_underscore):
+                start, delimiter = next_star, '**'
+            else:
+                start, delimiter = next_underscore, '__'
+
+            end = text.find(delimiter, start + 2)
+            if end != -1 and text.find('\n', start + 2, end) == -1:
+                runs.append((text[plain_start:start], None))
+                runs.append((text[start + 2:end], delimiter))
+                plain_start = search_from = end + 2
+            elif end == -1:
+                # Nothing left to close this delimiter, so it can never open a span again
+                search_from = start + 1
+                if delimiter == '**':
+                    next_star = -1
+                else:
+                    next_underscore = -1
+            else:
+                search_from = start + 1
+
+            if next_star != -1 and next_star < search_from:
+                next_star = text.find('**', search_from)
+            if next_underscore != -1 and next_underscore < search_from:
+                next_underscore = text.find('__', search_from)
 
-        run = paragraph.add_run()
-        run.text = parts[0]
+        runs.append((text[plain_start:], None))
+        return runs
 
-        for i in range(1, len(parts), 3):
-            delimiter = parts[i]
-            content = parts[i + 1]
+    def _prepare_slide(self, slide_info):
+        """
+        Converts one slide of LLM output into pre-split runs, without touching the presentation.
+        """
+        layout_name = slide_info.get("layout")
+        content = slide_info.get("content")
+
+        if layout_name == "title_slide":
+            return {
+                "layout": layout_name,
+                "title": self._split_markdown(content.get("title") or "Presentation Title"),
+                "subtitle": self._split_markdown(content.get("subtitle") or ""),
+            }
+        if layout_name == "bullet_points":
+            return {
+                "layout": layout_name,
+                "title": self._split_markdown(content.get("title") or "Slide Title"),
+                "points": [self._split_markdown(point_text) for point_text in content.get("points") or []],
+            }
+        if layout_name == "two_column":
+            return {
+                "layout": layout_name,
+                "title": self._split_markdown(content.get("title") or "Two Column Title"),
+                "left_column": self._prepare_column(content.get("left_column") or {}),
+                "right_column": self._prepare_column(content.get("right_column") or {}),
+            }
+        return None
+
+    def _prepare_column(self, column_data):
+        paragraphs = []
+        if column_data.get("heading"):
+            paragraphs.append((self._split_markdown(column_data["heading"]), 0))
+        for point_text in column_data.get("points") or []:
+            paragraphs.append((self._split_markdown(point_text), 1))
+        return paragraphs
+
+    def _apply_runs(self, paragraph, runs, is_title=False):
+        """
+        Adds pre-split runs to the paragraph, applying markdown emphasis and the presentation font style.
+        """
+        paragraph.clear()
 
+        for text, delimiter in runs:
             run = paragraph.add_run()
-            run.text = content
+            run.text = text
 
             if delimiter == '**':
                 run.font.bold = True
             elif delimiter == '__':
                 run.font.underline = True
+            self._style_run(run, is_title)
 
-            if (i + 2) < len(parts):
-                run = paragraph.add_run()
-                run.text = parts[i + 2]
-
-    def create_presentation(self, presentation_data: dict, output_path: str, aspect_ratio: str) -> None:
+    def create_presentation(self, presentation_data: dict, aspect_ratio: str) -> bytes:
         """
-        Creates a .pptx file from structured data.
+        Creates a .pptx presentation from structured data and returns the file contents.
         """
         # --- NEW: Choose the template file based on the aspect ratio ---
-        template_path = 'template_16_9.pptx'
-        if aspect_ratio == "4:3":
-            template_path = 'template_4_3.pptx'
-
-        try:
-            prs = Presentation(template_path)
-            print(f"Using template: {template_path}")
-        except FileNotFoundError:
-            print(f"WARNING: '{template_path}' not found. Using default blank presentation.")
+        if aspect_ratio != "4:3":
+            aspect_ratio = "16:9"
+        template_path = self.TEMPLATE_PATHS[aspect_ratio]
+        template_bytes = self._template_bytes[aspect_ratio]
+
+        # Split all markdown up front so the python-pptx pass below only mutates the DOM
+        prepared_slides = [self._prepare_slide(slide_info) for slide_info in presentation_data.get("slides", [])]
+
+        if template_bytes is not None:
+            prs = Presentation(io.BytesIO(template_bytes))
+            logger.debug("Using template: %s", template_path)
+        else:
+            logger.warning("'%s' not found. Using default blank presentation.", template_path)
             prs = Presentation()
 
+        # Look up each slide layout once rather than once per slide
+        used_layouts = {slide["layout"] for slide in prepared_slides if slide is not None}
+        layouts = {
+            layout_name: prs.slide_layouts[layout_index]
+            for layout_name, layout_index in self.LAYOUT_INDICES.items()
+            if layout_name in used_layouts
+        }
 
-        for slide_info in presentation_data.get("slides", []):
-            layout_name = slide_info.get("layout")
-            content = slide_info.get("content")
+        for slide in prepared_slides:
+            if slide is None:
+                continue
 
+            layout_name = slide["layout"]
             if layout_name == "title_slide":
-                self._add_title_slide(prs, content)
+                self._add_title_slide(prs, layouts[layout_name], slide)
             elif layout_name == "bullet_points":
-                self._add_bullet_points_slide(prs, content)
+                self._add_bullet_points_slide(prs, layouts[layout_name], slide)
             elif layout_name == "two_column":
-                self._add_two_column_slide(prs, content)
+                self._add_two_column_slide(prs, layouts[layout_name], slide)
 
-        prs.save(output_path)
+        buffer = io.BytesIO()
+        prs.save(buffer)
+        return buffer.getvalue()
 
-    def _apply_font_style(self, text_frame, is_title=False):
-        for paragraph in text_frame.paragraphs:
-            for run in paragraph.runs:
-                if is_title:
-                    if run.font.bold is not True: run.font.name = PresentationStyles.TITLE_FONT_NAME
-                    run.font.size = PresentationStyles.TITLE_FONT_SIZE
-                    run.font.color.rgb = PresentationStyles.TITLE_COLOR
-                else:
-                    if run.font.bold is not True: run.font.name = PresentationStyles.BODY_FONT_NAME
-                    run.font.size = PresentationStyles.BODY_FONT_SIZE
-                    run.font.color.rgb = PresentationStyles.BODY_COLOR
-
-    def _add_title_slide(self, prs, content):
-        slide_layout = prs.slide_layouts[0]
+    def _add_title_slide(self, prs, slide_layout, prepared):
         slide = prs.slides.add_slide(slide_layout)
         title = slide.shapes.title
         subtitle = slide.placeholders[1]
 
-        self._process_markdown_to_runs(title.text_frame.paragraphs[0], content.get("title", "Presentation Title"))
-        self._process_markdown_to_runs(subtitle.text_frame.paragraphs[0], content.get("subtitle", ""))
+        self._apply_runs(title.text_frame.paragraphs[0], prepared["title"], is_title=True)
+        self._apply_runs(subtitle.text_frame.paragraphs[0], prepared["subtitle"])
 
-        self._apply_font_style(title.text_frame, is_title=True)
-        self._apply_font_style(subtitle.text_frame)
-
-    def _add_bullet_points_slide(self, prs, content):
-        slide_layout = prs.slide_layouts[1]
+    def _add_bullet_points_slide(self, prs, slide_layout, prepared):
         slide = prs.slides.add_slide(slide_layout)
         title_shape = slide.shapes.title
         body_shape = slide.placeholders[1]
 
-        self._process_markdown_to_runs(title_shape.text_frame.paragraphs[0], content.get("title", "Slide Title"))
-        self._apply_font_style(title_shape.text_frame, is_title=True)
+        self._apply_runs(title_shape.text_frame.paragraphs[0], prepared["title"], is_title=True)
 
         tf = body_shape.text_frame
         tf.clear()
 
-        for point_text in content.get("points", []):
+        for runs in prepared["points"]:
             p = tf.add_paragraph()
-            self._process_markdown_to_runs(p, point_text)
+            self._apply_runs(p, runs)
             p.level = 0
 
-        self._apply_font_style(tf)
-
-    def _add_two_column_slide(self, prs, content):
-        slide_layout = prs.slide_layouts[3]
+    def _add_two_column_slide(self, prs, slide_layout, prepared):
         slide = prs.slides.add_slide(slide_layout)
 
         title_shape = slide.shapes.title
-        self._process_markdown_to_runs(title_shape.text_frame.paragraphs[0], content.get("title", "Two Column Title"))
-        self._apply_font_style(title_shape.text_frame, is_title=True)
-
-        left_data = content.get("left_column", {})
-        left_tf = slide.placeholders[1].text_frame
-        left_tf.clear()
-
-        if left_data.get("heading"):
-            p_heading = left_tf.add_paragraph()
-            self._process_markdown_to_runs(p_heading, left_data["heading"])  # This now handles bolding
-            p_heading.level = 0
-
-        for point_text in left_data.get("points", []):
-            p_point = left_tf.add_paragraph()
-            self._process_markdown_to_runs(p_point, point_text)
-            p_point.level = 1
-
-        right_data = content.get("right_column", {})
-        right_tf = slide.placeholders[2].text_frame
-        right_tf.clear()
-
-        if right_data.get("heading"):
-            p_heading = right_tf.add_paragraph()
-            self._process_markdown_to_runs(p_heading, right_data["heading"])  # This now handles bolding
-            p_heading.level = 0
-
-        for point_text in right_data.get("points", []):
-            p_point = right_tf.add_paragraph()
-            self._process_markdown_to_runs(p_point, point_text)
-            p_point.level = 1
-
-        self._apply_font_style(left_tf)
-        self._apply_font_style(right_tf)
\ No newline at end of file
+        self._apply_runs(title_shape.text_frame.paragraphs[0], prepared["title"], is_title=True)
+
+        self._fill_column(slide.placeholders[1].text_frame, prepared["left_column"])
+        self._fill_column(slide.placeholders[2].text_frame, prepared["right_column"])
+
+    def _fill_column(self, text_frame, paragraphs):
+        text_frame.clear()
+
+        for runs, level in paragraphs:
+            p = text_frame.add_paragraph()
+            self._apply_runs(p, runs)
+            p.level = level